@@ -1,7 +1,7 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 import asyncio
-import subprocess
+import functools
 import argparse
 import sys
 import os
@@ -12,7 +12,6 @@ import xdg.Menu
 from typing import Dict, Iterable, Union, Optional, List, Callable, Tuple
 from pathlib import Path, PosixPath
 import pyinotify
-import pkg_resources
 
 import qubesadmin
 import qubesadmin.events
@@ -46,6 +45,15 @@ STATE_DICTIONARY = {
 FAVORITES_FEATURE = 'menu-favorites'
 DISPOSABLE_PREFIX = '@disp:'
 HOVER_TIMEOUT = 20
+# seconds to wait for more favorites changes before reloading them
+FAVORITES_RELOAD_DELAY = 0.1
+
+# the environment is static for the whole life of the menu process
+CURRENT_ENVIRONMENTS = frozenset(
+    os.environ.get('XDG_CURRENT_DESKTOP', '').split(':'))
+
+# glade and css files are installed as package data next to this module
+RESOURCE_DIR = Path(__file__).parent
 
 logger = logging.getLogger('qubes-appmenu')
 
@@ -86,17 +94,66 @@ def _debug(*args):
     print(args)
 
 
-def load_icon(icon_name, size: Gtk.IconSize = Gtk.IconSize.LARGE_TOOLBAR):
+def run_command(command: List[str]):
+    """
+    Start command in the background, with stdin and output redirected to
+    /dev/null.
+    """
+    # DO_NOT_REAP_CHILD (reaped by the child watch below) saves GLib's
+    # intermediate process; descriptors are closed in the child, as not all
+    # of ours are close-on-exec (e.g. pyinotify's)
+    pid, _stdin, _stdout, _stderr = GLib.spawn_async(
+        command,
+        flags=GLib.SpawnFlags.SEARCH_PATH |
+        GLib.SpawnFlags.DO_NOT_REAP_CHILD |
+        GLib.SpawnFlags.STDOUT_TO_DEV_NULL |
+        GLib.SpawnFlags.STDERR_TO_DEV_NULL)
+    GLib.child_watch_add(GLib.PRIORITY_DEFAULT, pid,
+                         lambda pid, _status: GLib.spawn_close_pid(pid))
+
+
+@functools.lru_cache(maxsize=None)
+def get_icon_size(size: Gtk.IconSize) -> Tuple[int, int]:
+    # there are only a handful of icon sizes and they do not change at
+    # runtime; memoized lazily to make sure Gtk is already initialized
     _, width, height = Gtk.icon_size_lookup(size)
+    return width, height
+
+
+def load_icon(icon_name, size: Gtk.IconSize = Gtk.IconSize.LARGE_TOOLBAR):
+    width, height = get_icon_size(size)
+    icon_theme = _get_icon_theme()
     try:
-        return GdkPixbuf.Pixbuf.new_from_file_at_size(icon_name, width, height)
-    except GLib.Error:
-        try:
-            # icon name is a path
-            return Gtk.IconTheme.get_default().load_icon(icon_name, width, 0)
-        except GLib.GError:
-            # icon not found in any way
-            return None
+        if icon_theme.has_icon(icon_name):
+            return _load_theme_icon(icon_name, width)
+        # icon name is a path; Qubes rewrites VM app icons in place (e.g. on
+        # label change), so the file's mtime is part of the cache key
+        mtime = os.stat(icon_name).st_mtime_ns
+        return _load_icon_file(icon_name, mtime, width, height)
+    except (GLib.Error, OSError):
+        # icon not found in any way; failures raise, so they are not cached
+        return None
+
+
+# the same icons are loaded for many rows; pixbufs are never modified after
+# loading, so they can be safely shared between Gtk.Images
+@functools.lru_cache(maxsize=512)
+def _load_theme_icon(icon_name, width):
+    return _get_icon_theme().load_icon(icon_name, width, 0)
+
+
+@functools.lru_cache(maxsize=512)
+def _load_icon_file(path, _mtime, width, height):
+    return GdkPixbuf.Pixbuf.new_from_file_at_size(path, width, height)
+
+
+@functools.lru_cache(maxsize=None)
+def _get_icon_theme() -> Gtk.IconTheme:
+    # the default icon theme is a per-process singleton
+    icon_theme = Gtk.IconTheme.get_default()
+    icon_theme.connect('changed',
+                       lambda *_args: _load_theme_icon.cache_clear())
+    return icon_theme
 
 
 class LimitedWidthLabel(Gtk.Label):
@@ -233,8 +290,7 @@ class AppEntry(Gtk.ListBoxRow):
 
     def run_app(self, vm):
         command = self.app_info.get_command_for_vm(vm)
-        subprocess.Popen(command, stdout=subprocess.DEVNULL,
-                         stdin=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        run_command(command)
         self.get_toplevel().get_application().hide_menu()
 
 
@@ -426,10 +482,7 @@ class ControlRow(Gtk.ListBoxRow):
 
     def run_app(self, vm):
         if self.command and self.is_sensitive():
-            subprocess.Popen([self.command, str(vm)],
-                         stdout=subprocess.DEVNULL,
-                         stderr=subprocess.DEVNULL,
-                         stdin=subprocess.DEVNULL)
+            run_command([self.command, str(vm)])
 
 
 class StartControlItem(ControlRow):
@@ -516,7 +569,6 @@ class DesktopFileManager:
         self.desktop_dirs = [
             Path(xdg.BaseDirectory.xdg_data_home) / 'applications',
             Path('/usr/share/applications')]
-        self.current_environments = os.environ['XDG_CURRENT_DESKTOP'].split(':')
 
         self.app_entries: Dict[Path, ApplicationInfo] = {}
 
@@ -582,12 +634,9 @@ class DesktopFileManager:
         if entry.getHidden():
             return False
         if entry.getOnlyShowIn():
-            return bool(set(entry.getOnlyShowIn()).intersection(
-                self.current_environments))
+            return not CURRENT_ENVIRONMENTS.isdisjoint(entry.getOnlyShowIn())
         if entry.getNotShowIn():
-            return not bool(
-                set(entry.getNotShowIn()).intersection(
-                    self.current_environments))
+            return CURRENT_ENVIRONMENTS.isdisjoint(entry.getNotShowIn())
         return True
 
     def initialize_watchers(self):
@@ -618,7 +667,7 @@ class NetworkIndicator(Gtk.Box):
         self.network_off = Gtk.Image.new_from_pixbuf(
             load_icon('qappmenu-networking-no', self.icon_size))
 
-        _, height, _ = Gtk.icon_size_lookup(self.icon_size)
+        _, height = get_icon_size(self.icon_size)
         self.network_on.set_size_request(-1, height * 1.3)
         self.network_off.set_size_request(-1, height * 1.3)
 
@@ -751,13 +800,17 @@ class VMTypeToggle:
         for button in self.buttons:
             button.set_relief(Gtk.ReliefStyle.NONE)
             button.add_events(Gdk.EventMask.ENTER_NOTIFY_MASK)
+            button.connect('size-allocate', self._set_button_width)
 
     def initialize_state(self):
         self.apps_toggle.set_active(True)
 
-        for button in self.buttons:
-            if button.get_size_request() == (-1, -1):
-                button.set_size_request(button.get_allocated_width()*1.2, -1)
+    def _set_button_width(self, button, allocation):
+        # allocated width is only known after the first size-allocate,
+        # reading it right after show_all() can give a bogus value
+        button.disconnect_by_func(self._set_button_width)
+        if button.get_size_request() == (-1, -1):
+            button.set_size_request(int(allocation.width * 1.2), -1)
 
     def connect_to_toggle(self, func):
         for button in self.buttons:
@@ -806,11 +859,7 @@ class SettingsEntry(Gtk.ListBoxRow):
         self.add(self.hbox)
 
     def run_app(self, vm):
-        subprocess.Popen(
-            ['qubes-vm-settings', vm.name],
-                         stdout=subprocess.DEVNULL,
-                         stderr=subprocess.DEVNULL,
-                         stdin=subprocess.DEVNULL)
+        run_command(['qubes-vm-settings', vm.name])
         self.get_toplevel().get_application().hide_menu()
 
 
@@ -965,6 +1014,14 @@ class FavoritesPage:
         self.desktop_file_manager = desktop_file_manager
         self.dispatcher = dispatcher
 
+        # last known value of the favorites feature, by VM name
+        self._favorites_cache: Dict[str, str] = {}
+        # VMs whose favorites changed since the last reload, with the new
+        # feature value, or None if it has to be read from qubesd
+        self._dirty_vms: Dict[str, Optional[str]] = {}
+        self._favorites_dirty = asyncio.Event()
+        self._connected_once = False
+
         self.app_list: Gtk.ListBox = builder.get_object('fav_app_list')
         self.app_list.connect('row-activated', self._app_clicked)
 
@@ -981,6 +1038,14 @@ class FavoritesPage:
             f'domain-feature-set:{FAVORITES_FEATURE}', self._feature_set)
         self.dispatcher.add_handler('domain-add', self._domain_added)
         self.dispatcher.add_handler('domain-delete', self._domain_deleted)
+        self.dispatcher.add_handler('connection-established',
+                                    self._connection_established)
+
+    def _get_favorites(self, vm) -> List[str]:
+        if vm.name not in self._favorites_cache:
+            self._favorites_cache[vm.name] = vm.features.get(
+                FAVORITES_FEATURE, '')
+        return self._favorites_cache[vm.name].split(' ')
 
     def _load_vms_favorites(self, vm):
         if isinstance(vm, str):
@@ -988,8 +1053,7 @@ class FavoritesPage:
                 vm = self.qapp.domains[vm]
             except KeyError:
                 return
-        favorites = vm.features.get(FAVORITES_FEATURE, '')
-        favorites = favorites.split(' ')
+        favorites = self._get_favorites(vm)
 
         is_local_vm = (vm.name == self.qapp.local_name)
 
@@ -1007,8 +1071,7 @@ class FavoritesPage:
         else:
             vm = app_info.qapp.domains[app_info.qapp.local_name]
 
-        feature = vm.features.get(FAVORITES_FEATURE, '').split(' ')
-        if app_info.entry_name in feature:
+        if app_info.entry_name in self._get_favorites(vm):
             self._add_from_app_info(app_info)
 
     def _add_from_app_info(self, app_info):
@@ -1019,7 +1082,14 @@ class FavoritesPage:
     def _app_clicked(self, _widget, row: AppEntry):
         row.run_app(row.app_info.vm)
 
-    def _feature_deleted(self, vm, _event, _feature, *args, **kwargs):
+    def _feature_deleted(self, vm, event, feature, *args, **kwargs):
+        # pylint: disable=unused-argument
+        # queued like _feature_set, so that a set quickly followed by
+        # a delete ends with the delete
+        self._dirty_vms[str(vm)] = ''
+        self._favorites_dirty.set()
+
+    def _remove_vms_favorites(self, vm):
         try:
             if str(vm) == self.qapp.local_name:
                 vm = None
@@ -1031,18 +1101,60 @@ class FavoritesPage:
         except Exception as ex:
             print("DEL", type(ex), ex)
 
-    def _feature_set(self, vm, event, feature, *args, **kwargs):
-        try:
-            self._feature_deleted(vm, event, feature)
-            self._load_vms_favorites(vm)
-        except Exception as ex:
-            print("UGHHH", ex)
+    def _feature_set(self, vm, event, feature, *args, value=None, **kwargs):
+        # pylint: disable=unused-argument
+        # feature changes tend to come in bursts (e.g. from scripts), so only
+        # mark the VM here and let reload_favorites handle it
+        self._dirty_vms[str(vm)] = value
+        self._favorites_dirty.set()
+
+    def _connection_established(self, *_args, **_kwargs):
+        # the first connection comes right after the cache was filled;
+        # only reconnects might have missed events
+        if not self._connected_once:
+            self._connected_once = True
+            return
+        # re-check everything that is cached
+        for vm_name in self._favorites_cache:
+            self._dirty_vms[vm_name] = None
+        self._favorites_dirty.set()
+
+    async def reload_favorites(self):
+        """
+        Reload favorites of VMs marked by _feature_set and _feature_deleted;
+        all changes that came within FAVORITES_RELOAD_DELAY are handled with
+        one reload.
+        """
+        while True:
+            await self._favorites_dirty.wait()
+            await asyncio.sleep(FAVORITES_RELOAD_DELAY)
+            self._favorites_dirty.clear()
+            dirty_vms, self._dirty_vms = self._dirty_vms, {}
+            for vm, value in dirty_vms.items():
+                try:
+                    try:
+                        domain = self.qapp.domains[vm]
+                    except KeyError:
+                        # VM is already gone, _domain_deleted handles that
+                        continue
+                    if value is None:
+                        value = domain.features.get(FAVORITES_FEATURE, '')
+                    if value == self._favorites_cache.get(vm):
+                        continue
+                    self._remove_vms_favorites(vm)
+                    self._favorites_cache[vm] = value
+                    self._load_vms_favorites(domain)
+                except Exception as ex:  # pylint: disable=broad-except
+                    # this must not kill the task
+                    logger.warning('Failed to reload favorites for vm %s: %s',
+                                   vm, ex)
 
     def _domain_added(self, _submitter, _event, vm, **_kwargs):
         self._load_vms_favorites(vm)
 
-    def _domain_deleted(self, _submitter, event, vm, **_kwargs):
-        self._feature_deleted(vm, event, None)
+    def _domain_deleted(self, _submitter, _event, vm, **_kwargs):
+        self._favorites_cache.pop(str(vm), None)
+        self._remove_vms_favorites(vm)
 
 
 class SettingsCategoryRow(HoverListBox):
@@ -1145,14 +1257,12 @@ class AppMenu(Gtk.Application):
 
         screen = Gdk.Screen.get_default()
         provider = Gtk.CssProvider()
-        provider.load_from_path(pkg_resources.resource_filename(
-            __name__, 'qubes-menu-dark.css'))
+        provider.load_from_path(str(RESOURCE_DIR / 'qubes-menu-dark.css'))
         Gtk.StyleContext.add_provider_for_screen(
             screen, provider, Gtk.STYLE_PROVIDER_PRIORITY_APPLICATION)
 
         self.builder = Gtk.Builder()
-        self.builder.add_from_file(pkg_resources.resource_filename(
-            __name__, 'qubes-menu.glade'))
+        self.builder.add_from_file(str(RESOURCE_DIR / 'qubes-menu.glade'))
         self.main_window: Gtk.Window = self.builder.get_object('main_window')
         self.main_window.focus_out_callback = self._focus_out
         self.main_notebook: Gtk.Notebook = \
@@ -1173,10 +1283,7 @@ class AppMenu(Gtk.Application):
 
     @staticmethod
     def _do_power_button(_widget):
-        subprocess.Popen('xfce4-session-logout',
-                         stdout=subprocess.DEVNULL,
-                         stderr=subprocess.DEVNULL,
-                         stdin=subprocess.DEVNULL)
+        run_command(['xfce4-session-logout'])
 
     def do_activate(self, *args, **kwargs):
         # this should be just show, also:
@@ -1214,26 +1321,37 @@ class AppMenu(Gtk.Application):
 
         self.app_page = AppPage(self.qapp, self.builder,
                                 self.desktop_file_manager, self.dispatcher)
+        # favorites page listens for events, so it has to be ready before
+        # the dispatcher starts
         self.favorites_page = FavoritesPage(self.qapp, self.builder,
                                             self.desktop_file_manager,
                                             self.dispatcher)
-        self.settings_page = SettingsPage(self.qapp, self.builder,
-                                          self.desktop_file_manager,
-                                          self.dispatcher)
         self.power_button.connect('clicked', self._do_power_button)
         self.main_notebook.connect('switch-page', self._handle_page_switch)
 
         self.tasks = [
-            asyncio.ensure_future(self.dispatcher.listen_for_events())]
+            asyncio.ensure_future(self.dispatcher.listen_for_events()),
+            asyncio.ensure_future(self.favorites_page.reload_favorites())]
+
+        # the menu always opens on the app page; idle callbacks run after
+        # the window is drawn, so the settings page does not delay it
+        GLib.idle_add(self._setup_settings_page)
+
+    def _setup_settings_page(self):
+        self.settings_page = SettingsPage(self.qapp, self.builder,
+                                          self.desktop_file_manager,
+                                          self.dispatcher)
+        # the user might have switched to the page before it was built
+        if self.main_notebook.get_current_page() == 2:
+            self.settings_page.initialize_state()
+        return False
 
     def _handle_page_switch(self, _widget, _page, page_num):
         if page_num == 0:
             self.app_page.initialize_state()
-        elif page_num == 2:
+        elif page_num == 2 and self.settings_page:
             self.settings_page.initialize_state()
 
-    def do_shutdown(self, *args, **kwargs):
-        print("go away!")
 
 def main():
     """
@@ -1244,17 +1362,27 @@ def main():
     dispatcher = qubesadmin.events.EventsDispatcher(qapp)
     app = AppMenu(qapp, dispatcher, args.keep_visible)
     loop = asyncio.get_event_loop()
-    app.run()
+    # running the application through gbulb makes the loop the running
+    # asyncio loop for as long as the application runs
+    loop.run_forever(application=app)
 
     if not app.primary:
         return
 
-    done, _unused = loop.run_until_complete(asyncio.wait(
-            app.tasks, return_when=asyncio.FIRST_EXCEPTION))
+    for task in app.tasks:
+        task.cancel()
+    # the loop is now bound to the application and would start it again if
+    # run, so let the cancellations through by iterating GLib directly
+    context = GLib.main_context_default()
+    while not all(task.done() for task in app.tasks):
+        context.iteration(True)
 
     exit_code = 0
 
-    for d in done:  # pylint: disable=invalid-name
+    # only report the tasks that died on their own
+    for d in app.tasks:  # pylint: disable=invalid-name
+        if d.cancelled():
+            continue
         try:
             d.result()
         except Exception as _ex:  # pylint: disable=broad-except